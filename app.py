@@ -1,52 +1,84 @@
+import hashlib
 import os
+import shutil
 import subprocess
 import streamlit as st
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 import json
-from lecture_rag_pipeline import LectureRAGPipeline
+import numpy as np
+from lecture_rag_pipeline import LectureRAGPipeline, read_segments
 
 # --- Directories ---
 os.makedirs("uploads", exist_ok=True)
-os.makedirs("audio", exist_ok=True)
 os.makedirs("transcripts", exist_ok=True)
 
+# --- Transcript panel page size ---
+SEGMENTS_PER_PAGE = 50
+
 # --- Audio extraction using FFmpeg ---
-def extract_audio_ffmpeg(video_path: str, output_audio_path: str):
+def extract_audio_ffmpeg(video_path: str) -> np.ndarray:
+    # raw 16 kHz mono PCM on stdout, fed to Whisper without a WAV roundtrip through disk
     command = [
         "ffmpeg", "-y",
         "-i", video_path,
-        "-vn", "-acodec", "pcm_s16le",
-        "-ar", "16000", "-ac", "1", output_audio_path
+        "-vn", "-f", "s16le", "-acodec", "pcm_s16le",
+        "-ar", "16000", "-ac", "1", "-"
     ]
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 20)
     if result.returncode != 0:
         raise Exception(result.stderr.decode())
+    return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
 
 # --- Whisper Model Loader ---
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "distil-small.en")
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "cuda")
+WHISPER_COMPUTE = os.environ.get("WHISPER_COMPUTE", "int8_float16" if WHISPER_DEVICE == "cuda" else "int8")
+
 @st.cache_resource
 def load_model():
-    return WhisperModel("tiny", device="cuda", compute_type="float16")
+    model = WhisperModel(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE)
+    # warm up on 15s of silence so the first real upload doesn't pay for kernel/allocator setup
+    warmup, _ = model.transcribe(np.zeros(16000 * 15, dtype=np.float32), beam_size=1, language="en")
+    list(warmup)
+    # batch VAD segments into one decoder call instead of decoding them one by one
+    return BatchedInferencePipeline(model=model)
+
+# --- RAG Pipeline Loader ---
+@st.cache_resource
+def load_rag_pipeline():
+    return LectureRAGPipeline()
 
 # --- Transcribe ---
-def transcribe_audio(model, audio_path):
-    segments, info = model.transcribe(audio_path, beam_size=5, language="en")
-    transcript_segments = []
-    full_text = ""
-    for seg in segments:
-        text = seg.text.strip()
-        start = round(seg.start, 2)
-        end = round(seg.end, 2)
-        transcript_segments.append({"start": start, "end": end, "text": text})
-        full_text += f"[{start}s - {end}s] {text}\n"
-    return full_text, transcript_segments
-
-# --- Save Transcript JSON ---
-def save_transcript(segments, video_id):
-    path = f"transcripts/{video_id}.json"
-    enriched = [{"video_id": video_id, **s} for s in segments]
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(enriched, f, ensure_ascii=False, indent=2)
-    return path
+def transcribe_audio(model, audio, video_id):
+    # segments are written as JSONL while Whisper decodes them, so the UI can render them as they arrive
+    segments, info = model.transcribe(audio, batch_size=16, beam_size=5, language="en")
+    path = f"transcripts/{video_id}.jsonl"
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        for seg in segments:
+            segment = {"video_id": video_id, "start": round(seg.start, 2), "end": round(seg.end, 2), "text": seg.text.strip()}
+            f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+            yield segment
+    os.replace(path + ".part", path)
+
+# --- Upload Deduplication ---
+def upload_digest(uploaded_file) -> str:
+    # every widget interaction reruns the script, so hash each upload once and remember it for the session
+    key = f"digest-{uploaded_file.file_id}"
+    if key not in st.session_state:
+        # hash the in-memory upload without copying it; OpenSSL's sha256 uses the CPU's SHA extensions
+        st.session_state[key] = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    return st.session_state[key]
+
+def is_transcribed(video_id, digest):
+    digest_path = f"transcripts/{video_id}.sha256"
+    if not (os.path.exists(digest_path) and os.path.exists(f"transcripts/{video_id}.jsonl")):
+        return False
+    with open(digest_path, "r", encoding="utf-8") as f:
+        return f.read() == digest
+
+def save_digest(video_id, digest):
+    with open(f"transcripts/{video_id}.sha256", "w", encoding="utf-8") as f:
+        f.write(digest)
 
 # --- Main UI ---
 st.title("🎓 Lecture Intelligence Assistant")
@@ -55,38 +87,41 @@ st.title("🎓 Lecture Intelligence Assistant")
 uploaded_file = st.file_uploader("📤 Upload Lecture Video (.mp4)", type=["mp4"])
 if uploaded_file:
     video_path = f"uploads/{uploaded_file.name}"
-    with open(video_path, "wb") as f:
-        f.write(uploaded_file.read())
-    st.success(f"Video saved at: {video_path}")
-
-    audio_path = f"audio/{uploaded_file.name.replace('.mp4', '.wav')}"
-
-    st.info("🔊 Extracting audio...")
-    try:
-        extract_audio_ffmpeg(video_path, audio_path)
-        st.success(f"Audio extracted at: {audio_path}")
-    except Exception as e:
-        st.error(f"❌ Audio extraction failed: {e}")
-
-    st.info("🧠 Transcribing with Whisper...")
-    try:
-        model = load_model()
-        full_text, segments = transcribe_audio(model, audio_path)
-        st.success("✅ Transcription complete!")
-
-        with st.expander("📄 Transcript Preview"):
-            st.text(full_text)
-
-        with st.expander("📋 Timestamped Segments"):
-            for s in segments:
-                st.markdown(f"**[{s['start']}s - {s['end']}s]**: {s['text']}")
-
-        video_id = uploaded_file.name.replace(".mp4", "")
-        save_transcript(segments, video_id)
-        st.success("📁 Transcript saved!")
-
-    except Exception as e:
-        st.error(f"❌ Transcription failed: {e}")
+    video_id = uploaded_file.name.replace(".mp4", "")
+    digest = upload_digest(uploaded_file)
+
+    # Streamlit reruns this script on every interaction; the same video must not be re-transcribed
+    if is_transcribed(video_id, digest):
+        st.success(f"✅ {uploaded_file.name} is already transcribed.")
+    else:
+        uploaded_file.seek(0)
+        with open(video_path, "wb") as f:
+            # copy in 1 MB blocks instead of materializing the whole video as one bytes object
+            shutil.copyfileobj(uploaded_file, f, length=1 << 20)
+        st.success(f"Video saved at: {video_path}")
+
+        st.info("🔊 Extracting audio...")
+        audio = None
+        try:
+            audio = extract_audio_ffmpeg(video_path)
+            st.success(f"Audio extracted: {len(audio) / 16000:.1f}s")
+        except Exception as e:
+            st.error(f"❌ Audio extraction failed: {e}")
+
+        st.info("🧠 Transcribing with Whisper...")
+        try:
+            model = load_model()
+            with st.expander("📋 Timestamped Segments", expanded=True):
+                for s in transcribe_audio(model, audio, video_id):
+                    st.markdown(f"**[{s['start']}s - {s['end']}s]**: {s['text']}")
+            st.success("✅ Transcription complete!")
+
+            save_digest(video_id, digest)
+            load_rag_pipeline().invalidate(video_id)
+            st.success("📁 Transcript saved!")
+
+        except Exception as e:
+            st.error(f"❌ Transcription failed: {e}")
 
 st.markdown("---")
 
@@ -104,11 +139,13 @@ if selected_video:
 
     with col2:
         st.markdown("### 📝 Transcript Segments")
-        transcript_path = f"transcripts/{video_id}.json"
-        if os.path.exists(transcript_path):
-            with open(transcript_path, "r", encoding="utf-8") as f:
-                segments = json.load(f)
-            for i, s in enumerate(segments):
+        segments = read_segments(video_id)
+        if segments is not None:
+            # render one page of segments; a widget per segment for a whole lecture stalls the UI
+            pages = max(1, -(-len(segments) // SEGMENTS_PER_PAGE))
+            page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"page-{video_id}")
+            offset = (page - 1) * SEGMENTS_PER_PAGE
+            for i, s in enumerate(segments[offset:offset + SEGMENTS_PER_PAGE], start=offset):
                 start = s["start"]
                 end = s["end"]
                 text = s["text"]
@@ -122,13 +159,15 @@ if selected_video:
     st.subheader("💬 Ask a question from this lecture")
 
     query = st.text_input("Your Question")
-    if query:
-        rag = LectureRAGPipeline()
-        rag.run_pipeline(video_id)
-        result = rag.qa_chain({"query": query}, return_source_documents=True)
+    if query and segments is None:
+        st.warning("Transcript not found. Run transcription first.")
+    elif query:
+        answer, docs = load_rag_pipeline().query(query, video_id)
 
         st.markdown("**🧠 Answer:**")
-        st.write(result["result"])
+        st.write(answer)
 
         st.markdown("### 🔗 Matched Transcript Segments")
+        for doc in docs:
+            st.markdown(f"**[{doc.metadata['start']}s - {doc.metadata['end']}s]**: {doc.page_content}")
 
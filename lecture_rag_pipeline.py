@@ -1,75 +1,247 @@
-import json
-from typing import List
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import chromadb
+import orjson
 from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import OpenAIEmbeddings
 from langchain_core.documents import Document
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain_community.chat_models import ChatOpenAI
 from langchain_core.embeddings import Embeddings
 import requests
 
+# transcript fields are already well-typed, skip pydantic validation (model_construct on pydantic v2)
+_new_document = getattr(Document, "model_construct", None) or Document.construct
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"[^.!?]+")
+
+
+def _literal_terms(text: str) -> set:
+    # names, acronyms and numbers. A capital on the first word of a sentence (every Whisper segment
+    # starts with one) says nothing, so that word only counts for a digit or a capital past its first letter
+    terms = set()
+    for sentence in _SENTENCE_RE.findall(text):
+        for i, w in enumerate(_WORD_RE.findall(sentence)):
+            tail = w[1:] if i == 0 else w
+            if len(w) > 1 and (any(c.isdigit() for c in w) or not tail.islower()):
+                terms.add(w.lower())
+    return terms
+
+
+def read_segments(video_id: str) -> Optional[List[dict]]:
+    path = f"transcripts/{video_id}.jsonl"
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return [orjson.loads(line) for line in f]
+    # transcripts written before the switch to JSONL are a single JSON array
+    legacy_path = f"transcripts/{video_id}.json"
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "rb") as f:
+            return orjson.loads(f.read())
+    return None
+
+
+def _sliding_chunks(text: str, size: int, overlap: int, snap: int = 50):
+    # fixed windows with overlap; a window edge is pulled back to a sentence end within `snap` chars
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(p, end - snap, end) for p in ".!?")
+            if cut > start:
+                end = cut + 1
+        yield start, text[start:end]
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+
 
 class LMStudioEmbeddings(Embeddings):
-    def __init__(self, endpoint_url: str = "http://localhost:1234/v1/embeddings", model_name: str = "text-embedding-nomic-embed-text-v1.5"):
+    def __init__(self, endpoint_url: str = "http://localhost:1234/v1/embeddings", model_name: str = "text-embedding-nomic-embed-text-v1.5", batch_size: int = 64, max_workers: int = 4, max_retries: int = 5, timeout: float = 60.0):
         self.endpoint_url = endpoint_url
         self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        # a stalled server must fail the request so the retry loop can run
+        self.timeout = timeout
+        # keep-alive connections to LM Studio, shared by the batch worker threads
+        self.session = requests.Session()
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
         payload = {"model": self.model_name, "input": texts}
         headers = {"Content-Type": "application/json"}
-        response = requests.post(self.endpoint_url, json=payload, headers=headers)
-        response.raise_for_status()
-        return [item['embedding'] for item in response.json()["data"]]
+        error = None
+        for attempt in range(self.max_retries):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            try:
+                response = self.session.post(self.endpoint_url, json=payload, headers=headers, timeout=self.timeout)
+                response.raise_for_status()
+                return [item['embedding'] for item in response.json()["data"]]
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # unreachable or stalled server: an oversized or queued batch may go through on retry
+                error = e
+            except requests.HTTPError as e:
+                # only server-side errors are worth retrying, 4xx means the request itself is wrong
+                if e.response.status_code < 500:
+                    raise
+                error = e
+        if error is None:
+            raise ValueError("max_retries must be at least 1")
+        raise error
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # one request per window of batch_size texts, sent concurrently; map keeps input order
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1:
+            return [e for batch in batches for e in self.embed_batch(batch)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return [e for embeddings in pool.map(self.embed_batch, batches) for e in embeddings]
 
     def embed_query(self, text: str) -> List[float]:
         return self.embed_documents([text])[0]
 
+class CachedEmbeddings(Embeddings):
+    # content-addressed cache in front of LM Studio, so re-ingesting a lecture only embeds changed chunks
+    def __init__(self, inner: LMStudioEmbeddings, path: str = "emb_cache.sqlite3"):
+        self.inner = inner
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def key(self, text: str) -> str:
+        return hashlib.blake2b(f"{self.inner.model_name}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self.lock:
+            # stay under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                window = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(window))})", window
+                )
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(t) for t in texts]
+        found = self.lookup(list(set(keys)))
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        if missing:
+            embeddings = self.inner.embed_documents(list(missing.values()))
+            found.update(zip(missing, embeddings))
+            with self.lock:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(k, array("f", e).tobytes()) for k, e in zip(missing, embeddings)]
+                )
+                self.conn.commit()
+        return [found[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.inner.embed_query(text)
+
 class LectureRAGPipeline:
+    # Chroma keeps vectors in an HNSW index; match the cosine metric the embedding model is trained for
+    collection_metadata = {"hnsw:space": "cosine"}
+    max_cached_lectures = 32
+    retrieval_k = 3
+
     def __init__(self, persist_dir: str = "chroma_db"):
         self.persist_dir = persist_dir
+        self.client = chromadb.PersistentClient(path=persist_dir)
+        self.embeddings = CachedEmbeddings(LMStudioEmbeddings())
+        # video_id -> (vectordb, qa_chain, literal_index), least recently used first
+        self._cache = OrderedDict()
+        # held only for _cache and _lecture_locks bookkeeping, never across I/O
+        self._cache_lock = threading.Lock()
+        # video_id -> RLock; a lecture's indexing, search and invalidation never overlap, other lectures proceed
+        self._lecture_locks = {}
+
+    def lecture_lock(self, video_id: str):
+        with self._cache_lock:
+            return self._lecture_locks.setdefault(video_id, threading.RLock())
+
+    def collection_name(self, video_id: str) -> str:
+        # Chroma only accepts [a-zA-Z0-9._-] names, video file names can be anything
+        return "lecture-" + hashlib.blake2b(video_id.encode("utf-8"), digest_size=8).hexdigest()
 
     def load_transcript(self, video_id: str) -> List[Document]:
-        path = f"transcripts/{video_id}.json"
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = read_segments(video_id)
+        if data is None:
+            raise FileNotFoundError(f"no transcript for {video_id}")
 
-        docs = []
-        for item in data:
-            docs.append(Document(
+        return [
+            _new_document(
                 page_content=item["text"],
                 metadata={
                     "video_id": item["video_id"],
                     "start": item["start"],
                     "end": item["end"]
                 }
-            ))
-        return docs
+            )
+            for item in data
+        ]
 
     def chunk_documents(self, docs: List[Document], chunk_size: int = 700, overlap: int = 100) -> List[Document]:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap)
-        return splitter.split_documents(docs)
-
-    def store_chunks(self, chunks: List[Document]):
-        self.vectordb = Chroma.from_documents(
-            chunks,
-            embedding=LMStudioEmbeddings(),
-            persist_directory=self.persist_dir
-        )
-        self.vectordb.persist()
+        return [
+            _new_document(page_content=chunk, metadata=doc.metadata | {"offset": offset})
+            for doc in docs
+            for offset, chunk in _sliding_chunks(doc.page_content, chunk_size, overlap)
+        ]
 
-    def load_vectorstore(self):
-        self.vectordb = Chroma(
-            persist_directory=self.persist_dir,
-            embedding_function=LMStudioEmbeddings()
-        )
+    def store_chunks(self, chunks: List[Document], video_id: str):
+        # embed everything up front and write straight to the collection, persisted by the client
+        texts = [c.page_content for c in chunks]
+        vectors = self.embeddings.embed_documents(texts)
+        # the chunk number lets the literal prefilter address chunks through a metadata filter
+        metadatas = [c.metadata | {"chunk": i} for i, c in enumerate(chunks)]
+        collection = self.client.get_or_create_collection(self.collection_name(video_id), metadata=self.collection_metadata)
+        step = self.client.get_max_batch_size()
+        for i in range(0, len(chunks), step):
+            collection.add(
+                ids=[str(j) for j in range(i, min(i + step, len(chunks)))],
+                embeddings=vectors[i:i + step],
+                documents=texts[i:i + step],
+                metadatas=metadatas[i:i + step]
+            )
 
-    def setup_qa_chain(self):
-        if self.vectordb is None:
-            self.load_vectorstore()
+    # the pipeline is shared by every Streamlit session, so per-lecture objects are returned, never kept on self
+    def load_vectorstore(self, video_id: str):
+        return Chroma(
+            client=self.client,
+            collection_name=self.collection_name(video_id),
+            embedding_function=self.embeddings,
+            collection_metadata=self.collection_metadata
+        )
 
-        retriever = self.vectordb.as_retriever(search_kwargs={"k": 3})
+    def build_literal_index(self, vectordb) -> dict:
+        stored = vectordb.get(include=["documents", "metadatas"])
+        index = {}
+        for text, metadata in zip(stored["documents"], stored["metadatas"]):
+            if "chunk" in metadata:
+                for term in _literal_terms(text):
+                    index.setdefault(term, set()).add(metadata["chunk"])
+        # only rare terms narrow anything; ones spread over many chunks (the lecture's topic) are dropped
+        limit = max(self.retrieval_k, len(stored["ids"]) // 20)
+        return {term: chunk_ids for term, chunk_ids in index.items() if len(chunk_ids) <= limit}
 
+    # answers over documents picked by retrieve(), which is the only retrieval path
+    def setup_qa_chain(self):
         llm = ChatOpenAI(
             base_url="http://localhost:1234/v1",
             api_key="lm-studio",  # dummy key for local models
@@ -77,15 +249,58 @@ class LectureRAGPipeline:
             temperature=0.2
         )
 
-        self.qa_chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
+        return load_qa_chain(llm, chain_type="stuff")
+
+    def retrieve(self, question: str, query_vector: List[float], vectordb, literal_index: dict) -> List[Document]:
+        k = self.retrieval_k
+        candidates = set().union(*(literal_index.get(t, ()) for t in _literal_terms(question)))
+        docs = []
+        # a rare name or number in the question: score only the chunks that mention it first
+        if candidates:
+            docs = vectordb.similarity_search_by_vector(query_vector, k=k, filter={"chunk": {"$in": sorted(candidates)}})
+        if len(docs) < k:
+            seen = {d.metadata.get("chunk") for d in docs}
+            rest = vectordb.similarity_search_by_vector(query_vector, k=k + len(docs))
+            docs += [d for d in rest if d.metadata.get("chunk") not in seen][:k - len(docs)]
+        return docs
+
+    def query(self, question: str, video_id: str) -> Tuple[str, List[Document]]:
+        # embed the question once, before locking: both searches reuse the vector and the
+        # LM Studio round-trip never holds up indexing or invalidation of the lecture
+        query_vector = self.embeddings.embed_query(question)
+        with self.lecture_lock(video_id):
+            vectordb, qa_chain, literal_index = self.load_lecture(video_id)
+            docs = self.retrieve(question, query_vector, vectordb, literal_index)
+        # the LLM call is the slow part and only touches local objects, so it runs unlocked
+        return qa_chain.run(input_documents=docs, question=question), docs
+
+    # drop the cached chain and stored chunks so the next run re-indexes the transcript
+    def invalidate(self, video_id: str):
+        with self.lecture_lock(video_id):
+            with self._cache_lock:
+                self._cache.pop(video_id, None)
+            self.load_vectorstore(video_id).delete_collection()
 
-    def query(self, question: str) -> str:
-        if self.qa_chain is None:
-            self.setup_qa_chain()
-        return self.qa_chain.run(question)
+    def load_lecture(self, video_id: str):
+        with self.lecture_lock(video_id):
+            with self._cache_lock:
+                entry = self._cache.get(video_id)
+                if entry is not None:
+                    self._cache.move_to_end(video_id)
+                    return entry
+            vectordb = self.load_vectorstore(video_id)
+            # transcripts are only embedded once, later runs reuse the persisted collection
+            if not vectordb.get(limit=1)["ids"]:
+                docs = self.load_transcript(video_id)
+                chunks = self.chunk_documents(docs)
+                self.store_chunks(chunks, video_id)
+            entry = (vectordb, self.setup_qa_chain(), self.build_literal_index(vectordb))
+            with self._cache_lock:
+                self._cache[video_id] = entry
+                if len(self._cache) > self.max_cached_lectures:
+                    self._cache.popitem(last=False)
+            return entry
 
+    # index and cache a lecture ahead of its first question
     def run_pipeline(self, video_id: str):
-        docs = self.load_transcript(video_id)
-        chunks = self.chunk_documents(docs)
-        self.store_chunks(chunks)
-        self.setup_qa_chain()
+        self.load_lecture(video_id)